@@ -1,27 +1,146 @@
+import sys
 import serial
-import serial.tools.list_ports_windows
+from serial.tools import list_ports
 import numpy as np
 import warnings
-from typing import Optional, Tuple, Any
+import threading
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Optional, Tuple, List, Any
 from types import NoneType
-from collections.abc import Callable
-
-def write_and_read(ser:serial.Serial, input_str:str, startsWith:str, eol_r:str, eol_w:str, cast_func:Callable) -> Any:
-    ser.reset_input_buffer()
-    ser.reset_output_buffer()
-    ser.write(startsWith.encode('utf-8')+input_str.encode('utf-8') + eol_w.encode('utf-8'))
-    ser.flush()
-    data = ser.read_until(eol_r.encode('utf-8'))
-    data = data.decode('utf-8')
-    assert data.startswith(startsWith), f"Device returned unexpected response: {data}"
-    if data.find(startsWith) + 1 == data.find(eol_r):
+from collections.abc import Callable, Collection
+try:
+    import serial_asyncio
+except ImportError:
+    serial_asyncio = None
+try:
+    from numba import njit
+except ImportError:
+    # without numba the kernels below simply run as plain Python
+    def njit(*args, **kwargs):
+        return lambda func: func
+
+# print every Nth wavelength reported during a scan
+_PROGRESS_EVERY = 5
+
+# zero-padded command arguments, built once instead of on every call
+_WL_BYTES = {i: b'%04d' % i for i in range(1510, 1590)}
+_FRAC_BYTES = {i: b'%04d' % i for i in range(0, 301)}
+
+_VALID_WL = frozenset(range(1510, 1590))
+_VALID_STAY = frozenset(range(1, 301))
+_VALID_SPAN = frozenset(range(1, 31))
+
+def _parse_response(data:bytes, startsWith:bytes, eol_r:bytes, cast_func:Callable) -> Any:
+    end = data.rfind(eol_r)
+    assert data[:1] == startsWith and end > 0, f"Device returned unexpected response: {data}"
+    if end == 1:
         return None
-    else: 
-        return cast_func(data[data.find(startsWith) + 1:data.find(eol_r)])
+    else:
+        return cast_func(data[1:end].decode('ascii'))
+
+def _read_reply(ser:serial.Serial, startsWith:bytes, eol_r:bytes) -> bytes:
+    data = ser.read_until(eol_r)
+    if data[:1] != startsWith or not data.endswith(eol_r):
+        # a stale reply may have been read first, so read once more; resending is not safe as I/D steps are relative
+        data = ser.read_until(eol_r)
+        if data[:1] != startsWith or not data.endswith(eol_r):
+            ser.reset_input_buffer()
+            raise AssertionError(f"Device returned unexpected response: {data}")
+    return data
+
+def write_and_read(ser:serial.Serial, input_bytes:bytes, startsWith:bytes, eol_r:bytes, eol_w:bytes, cast_func:Callable) -> Any:
+    # no flush, reading the reply already waits on the device
+    ser.write(b'%s%s%s' % (startsWith, input_bytes, eol_w))
+    return _parse_response(_read_reply(ser, startsWith, eol_r), startsWith, eol_r, cast_func)
+
+def _cmd_ack(ser:serial.Serial, prefix:bytes, payload:bytes) -> bytes:
+    # for commands whose reply is only an acknowledgement, so there is nothing to parse
+    ser.write(b'%s%s,' % (prefix, payload))
+    return _read_reply(ser, prefix, b' ')
+
+def write_and_read_pipelined(ser:serial.Serial, cmds:List[Tuple[bytes, bytes, bytes, bytes, Callable]]) -> List[Any]:
+    """
+    Send several commands in one burst, then read their responses in order
+
+    Parameters
+    ----------
+    ser : serial.Serial
+        Serial object to communicate with the filter
+    cmds : List[Tuple[bytes, bytes, bytes, bytes, Callable]]
+        commands as (input_bytes, startsWith, eol_r, eol_w, cast_func), as taken by write_and_read
+
+    Returns
+    -------
+    List[Any]
+        the parsed response of each command
+
+    Raises
+    ------
+    AssertionError
+        when a device error is encountered
+    """
+    ser.write(b''.join(b'%s%s%s' % (startsWith, input_bytes, eol_w) for input_bytes, startsWith, _, eol_w, _ in cmds))
+    return [_parse_response(ser.read_until(eol_r), startsWith, eol_r, cast_func)
+            for _, startsWith, eol_r, _, cast_func in cmds]
+
+# (vid, pid) of common USB-serial bridges: FTDI, CP210x, CH340 and Prolific
+_USB_SERIAL_IDS = (
+    (0x0403, 0x6001), (0x0403, 0x6010), (0x0403, 0x6014), (0x0403, 0x6015),
+    (0x10C4, 0xEA60),
+    (0x1A86, 0x7523),
+    (0x067B, 0x2303),
+)
+
+_PORT_CACHE = {'t': 0.0, 'v': None}
+_PORT_CACHE_LOCK = threading.Lock()
+
+def _port_number(port:Any) -> int:
+    return int(''.join(filter(str.isdigit, port.device)) or '9999')
+
+def _cached_comports(ttl:np.floating = 5.0) -> list:
+    with _PORT_CACHE_LOCK:
+        now = time.monotonic()
+        if _PORT_CACHE['v'] is None or now - _PORT_CACHE['t'] >= ttl:
+            # low-numbered ports are the likeliest to be the filter, so they go first
+            _PORT_CACHE['v'] = sorted(list_ports.comports(), key=_port_number)
+            _PORT_CACHE['t'] = now
+        return _PORT_CACHE['v']
+
+def _candidate_ports(port_cache_ttl:np.floating = 5.0, max_port:Optional[int] = None, vid_pid_allowlist:Collection[Tuple[int, int]] = _USB_SERIAL_IDS) -> list:
+    ports = _cached_comports(port_cache_ttl)
+    if max_port is not None:
+        ports = [port for port in ports if _port_number(port) <= max_port]
+    # opening unrelated devices can disturb them, so only fall back to every port when nothing matches
+    candidates = [port for port in ports if (port.vid, port.pid) in vid_pid_allowlist]
+    return candidates or ports
+
+def _probe(port:Any, supress_output:bool = False, **kwargs) -> Optional[serial.Serial]:
+    if not supress_output:
+        print(f"Scanning on {port.device}...")
+    ser = None
+    try:
+        ser = serial.Serial(port.device, 9600, timeout=0.1, **kwargs)
+        ser.reset_input_buffer()
+        ser.reset_output_buffer()
+        ser.write(b'V,')
+        data = ser.read_until(b' ')
+    except serial.SerialException:
+        data = b''
+    except BaseException:
+        if ser is not None:
+            ser.close()
+        raise
+    if data.startswith(b'V2'):
+        return ser
+    if ser is not None:
+        ser.close()
+    return None
 
-def connect(supress_output:bool = False, timeout:np.floating=1, **kwargs) -> Optional[serial.Serial]:
+def connect(supress_output:bool = False, timeout:np.floating=1, port_cache_ttl:np.floating=5.0, max_port:Optional[int]=None, vid_pid_allowlist:Collection[Tuple[int, int]]=_USB_SERIAL_IDS, **kwargs) -> Optional[serial.Serial]:
     """
-    Scan ports and find the first optical filter
+    Scan ports concurrently and find the first optical filter
     
     Parameters
     ----------
@@ -29,6 +148,12 @@ def connect(supress_output:bool = False, timeout:np.floating=1, **kwargs) -> Opt
         when set to True, status messages are suppressed
     timeout : np.floating
         set the time to wait for response from the filter before aborting
+    port_cache_ttl : np.floating
+        time in seconds for which the list of ports is reused between calls, 0 forces a refresh
+    max_port : Optional[int]
+        when set, ports numbered above it (e.g. COM9 for max_port=8) are not probed
+    vid_pid_allowlist : Collection[Tuple[int, int]]
+        USB (vid, pid) pairs of the serial bridges to probe, every port is probed when none match
     **kwargs
         other arguments when opening serial connection
 
@@ -37,21 +162,54 @@ def connect(supress_output:bool = False, timeout:np.floating=1, **kwargs) -> Opt
     serial.Serial
         Serial object to communicate with the filter
     """
-    ports = serial.tools.list_ports_windows.comports()
-    for port in ports:
-        if not supress_output:
-            print(f"Scanning on {port.device}...")
-        ser = serial.Serial(port.device, 9600, timeout=0.1, **kwargs)
-        ser.reset_input_buffer()
-        ser.reset_output_buffer()
-        ser.write(b'V,')
-        ser.flush()
-        data = ser.read_until(b' ')
-        if data.decode('utf-8').startswith('V2'):
-            ser.timeout = timeout
-            return ser
-        ser.close()
-    print("No optical filter found.")
+    ports = _candidate_ports(port_cache_ttl, max_port, vid_pid_allowlist)
+    found = None
+    error = None
+    if ports:
+        with ThreadPoolExecutor(max_workers=len(ports)) as executor:
+            futures = [executor.submit(_probe, port, supress_output, **kwargs) for port in ports]
+            # every future is drained so that no opened handle is left behind, even when one probe fails
+            for future in as_completed(futures):
+                if future.cancelled(): continue
+                try:
+                    ser = future.result()
+                except Exception as e:
+                    error = error or e
+                    continue
+                if ser is None: continue
+                if found is None:
+                    found = ser
+                    for other in futures: other.cancel()
+                else: ser.close()
+    if found is None:
+        if error is not None: raise error
+        print("No optical filter found.")
+        return None
+    found.timeout = timeout
+    return found
+
+def _print_progress(out:Any, payload:bytes) -> NoneType:
+    # pythonw and services run without a stdout at all
+    if sys.stdout is None: return
+    if out is None: print(f"Scanning wavelength {payload.decode('ascii')}", end='\r', flush=True)
+    else:
+        out.write(b'Scanning wavelength %s\r' % payload)
+        out.flush()
+
+def _check_scan_args(start:int, end:int, stay:np.floating, span:int) -> int:
+    _stay = int(round(stay * 10))
+    if (start in _VALID_WL) & (end in _VALID_WL) & (_stay in _VALID_STAY) & (span in _VALID_SPAN):
+        return _stay
+    # slow path, only taken to report which argument is invalid
+    if start < 1510 or start > 1589:
+        raise ValueError(f"The start wavelength has to be between 1510 and 1589, got {start}.")
+    elif end < 1510 or end > 1589:
+        raise ValueError(f"The end wavelength has to be between 1510 and 1589, got {end}.")
+    elif _stay < 1 or _stay > 300:
+        raise ValueError(f"The stay time has to be between 0.1 and 30.0, got {stay}.")
+    elif span < 1 or span > 30:
+        raise ValueError(f"The stay span has to be between 1 and 30, got {span}.")
+    raise ValueError(f"The start, end and span have to be integers, got {start}, {end} and {span}.")
 
 def scan(ser:serial.Serial, start:int, end:int, stay:np.floating, span:int, supress_output:bool = False) -> Tuple[int, int, np.floating]:
     """
@@ -82,36 +240,52 @@ def scan(ser:serial.Serial, start:int, end:int, stay:np.floating, span:int, supr
     AssertionError
         when a device error is encountered
     """
-    ser.reset_input_buffer()
-    ser.reset_output_buffer()
-    _stay = int(np.round(stay * 10))
-    if start < 1510 or start > 1589:
-        raise ValueError(f"The start wavelength has to be between 1510 and 1589, got {start}.")
-    elif end < 1510 or end > 1589:
-        raise ValueError(f"The end wavelength has to be between 1510 and 1589, got {end}.")
-    elif _stay < 1 or _stay > 300:
-        raise ValueError(f"The stay time has to be between 0.1 and 30.0, got {stay}.")
-    elif span < 1 or span > 30:
-        raise ValueError(f"The stay span has to be between 1 and 30, got {span}.")
-    
-    start_prev = write_and_read(ser, str(start).zfill(4), 'L', ' ', ',', int)
-    end_prev = write_and_read(ser, str(end).zfill(4), 'H', ' ', ',', int)
-    stay_prev = write_and_read(ser, str(_stay).zfill(4), 'T', ' ', ',', int) / 10
+    if ser.in_waiting > 0:
+        ser.reset_input_buffer()
+        ser.reset_output_buffer()
+    _stay = _check_scan_args(start, end, stay, span)
+
+    start_prev, end_prev, stay_prev = write_and_read_pipelined(ser, [
+        (_WL_BYTES[start], b'L', b' ', b',', int),
+        (_WL_BYTES[end], b'H', b' ', b',', int),
+        (_FRAC_BYTES[_stay], b'T', b' ', b',', int),
+    ])
+    stay_prev /= 10
 
     
+    # block in the kernel between status messages instead of polling on the timeout
+    old_timeout = ser.timeout
+    ser.timeout = None
     try:
-        ser.write(('S'+str(span).zfill(4)+',').encode('utf-8'))
+        ser.write(b'S%s,' % _FRAC_BYTES[span])
         ser.flush()
+        out = None
+        if not supress_output and sys.stdout is not None:
+            # notebooks replace sys.stdout with a text-only stream
+            out = getattr(sys.stdout, 'buffer', None)
+            # anything still pending in the text layer has to go out before writing under it
+            sys.stdout.flush()
+        end_b = _WL_BYTES[end]
+        count = 0
+        pending = b''
+        data = b''
         while True:
-            data = b''
-            while data == b'':
-                data = ser.read_until(b' ')
-            data = data.decode('utf-8')
-            assert data.startswith('S'), f"Device returned unexpected response: {data}"
-            if data.find('S') + 1 == data.find(' ') or supress_output: continue
-            else: print(f"Scanning wavelength {data[data.find('S') + 1 : data.find(' ')]}", end='\r')
+            data = ser.read_until(b' ')
+            if not data.startswith(b'S'): raise AssertionError(f"Device returned unexpected response: {data}")
+            payload = data[1:-1]
+            if not payload or supress_output: continue
+            count += 1
+            # the first, every Nth and the end wavelength are shown
+            if count == 1 or not count % _PROGRESS_EVERY or payload == end_b:
+                _print_progress(out, payload)
+                pending = b''
+            else: pending = payload
     except AssertionError as e:
-        if not data.startswith('o'): raise e
+        if not data.startswith(b'o'): raise e
+        # the last wavelength reported is always shown, even if the scan stopped short of end
+        if pending: _print_progress(out, pending)
+    finally:
+        ser.timeout = old_timeout
 
     return start_prev, end_prev, stay_prev
 
@@ -139,18 +313,233 @@ def set_channel(ser:serial.Serial, wl:np.floating, suppress_output:bool = False)
     ValueError
         when the input wavelength is invalid
     """
-    ser.reset_input_buffer()
-    ser.reset_output_buffer()
-    wl_int = int(np.round(wl))
-    wl_fl = int(np.round((wl - wl_int) / 0.2))
-    if wl_int < 1510 or wl_int > 1589:
+    if ser.in_waiting > 0:
+        ser.reset_input_buffer()
+        ser.reset_output_buffer()
+    wl_int = int(round(wl))
+    wl_fl = int(round((wl - wl_int) * 5))
+    if wl_int not in _VALID_WL:
         raise ValueError(f"The wavelength has to be between 1510 and 1589, got {wl}.")
-    write_and_read(ser, str(wl_int).zfill(4), 'C', ' ', ',', None)
+    _cmd_ack(ser, b'C', _WL_BYTES[wl_int])
     if not suppress_output and wl - (wl_int + wl_fl * 0.2) > 1e-6:
             warnings.warn(f"{wl} not achieveable, setting to closest wavelength {wl_int + wl_fl * 0.2}")
     if wl_fl == 0: return 0
     else:
         if wl_fl < 0:
-            write_and_read(ser, str(-wl_fl).zfill(4), 'D', ' ', ',', None)
+            _cmd_ack(ser, b'D', _FRAC_BYTES[-wl_fl])
         else:
-                write_and_read(ser, str(wl_fl).zfill(4), 'I', ' ', ',', None)
\ No newline at end of file
+                _cmd_ack(ser, b'I', _FRAC_BYTES[wl_fl])
+
+@njit(cache=True)
+def _compute_pairs(wls:np.ndarray) -> np.ndarray:
+    out = np.empty((wls.size, 2), np.int32)
+    for i in range(wls.size):
+        wi = round(wls[i])
+        out[i, 0] = wi
+        out[i, 1] = round((wls[i] - wi) * 5)
+    return out
+
+def set_channels(ser:serial.Serial, wls:np.ndarray, callback:Optional[Callable] = None, suppress_output:bool = False) -> NoneType:
+    """
+    Sets the filter on each wavelength of an array in turn, rounding to the closest .2nm increment like set_channel.
+    
+    Parameters
+    ----------
+    ser : serial.Serial
+        Serial object to communicate with the filter
+    wls : np.ndarray
+        wavelengths to step through, in order
+    callback : Optional[Callable]
+        called with each wavelength the filter was set to, e.g. to take a measurement before the next step
+    suppress_output : bool
+        when set to True, status messages are suppressed
+
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    AssertionError
+        when a device error is encountered
+    ValueError
+        when any input wavelength is invalid, in which case nothing is sent to the filter
+    """
+    wls = np.ascontiguousarray(wls, dtype=np.float64).ravel()
+    # checked on the floats, before the kernel narrows them to int32 where out-of-range values could wrap
+    invalid = ~np.isfinite(wls) | (wls < 1509.5) | (wls >= 1589.5)
+    if invalid.any():
+        raise ValueError(f"The wavelengths have to be between 1510 and 1589, got {wls[invalid]}.")
+    pairs = _compute_pairs(wls)
+    actual = pairs[:, 0] + pairs[:, 1] * 0.2
+    if not suppress_output and (np.abs(wls - actual) > 1e-6).any():
+        warnings.warn(f"{wls[np.abs(wls - actual) > 1e-6]} not achieveable, setting to closest wavelengths")
+    if ser.in_waiting > 0:
+        ser.reset_input_buffer()
+        ser.reset_output_buffer()
+    for (wl_int, wl_fl), wl in zip(pairs.tolist(), actual.tolist()):
+        _cmd_ack(ser, b'C', _WL_BYTES[wl_int])
+        if wl_fl < 0:
+            _cmd_ack(ser, b'D', _FRAC_BYTES[-wl_fl])
+        elif wl_fl > 0:
+            _cmd_ack(ser, b'I', _FRAC_BYTES[wl_fl])
+        if callback is not None:
+            callback(wl)
+
+def _require_serial_asyncio() -> NoneType:
+    if serial_asyncio is None:
+        raise ImportError("The async API requires pyserial-asyncio, install it with `pip install pyserial-asyncio`.")
+
+async def write_and_read_pipelined_async(reader:asyncio.StreamReader, writer:asyncio.StreamWriter, cmds:List[Tuple[bytes, bytes, bytes, bytes, Callable]]) -> List[Any]:
+    """
+    Async counterpart of write_and_read_pipelined
+
+    Parameters
+    ----------
+    reader : asyncio.StreamReader
+        stream to read responses from the filter
+    writer : asyncio.StreamWriter
+        stream to send commands to the filter
+    cmds : List[Tuple[bytes, bytes, bytes, bytes, Callable]]
+        commands as (input_bytes, startsWith, eol_r, eol_w, cast_func), as taken by write_and_read
+
+    Returns
+    -------
+    List[Any]
+        the parsed response of each command
+
+    Raises
+    ------
+    AssertionError
+        when a device error is encountered
+    """
+    writer.write(b''.join(b'%s%s%s' % (startsWith, input_bytes, eol_w) for input_bytes, startsWith, _, eol_w, _ in cmds))
+    return [_parse_response(await reader.readuntil(eol_r), startsWith, eol_r, cast_func)
+            for _, startsWith, eol_r, _, cast_func in cmds]
+
+async def _read_version_async(reader:asyncio.StreamReader) -> bytes:
+    while True:
+        data = await reader.readuntil(b' ')
+        if data.startswith(b'V'):
+            return data
+
+async def _probe_async(port:Any, supress_output:bool = False, **kwargs) -> Optional[Tuple[asyncio.StreamReader, asyncio.StreamWriter]]:
+    if not supress_output:
+        print(f"Scanning on {port.device}...")
+    writer = None
+    try:
+        reader, writer = await serial_asyncio.open_serial_connection(url=port.device, baudrate=9600, **kwargs)
+        # drop leftovers still in the port, then skip stale replies the transport already buffered
+        writer.transport.serial.reset_input_buffer()
+        writer.write(b'V,')
+        data = await asyncio.wait_for(_read_version_async(reader), 0.1)
+    except (serial.SerialException, asyncio.TimeoutError, asyncio.IncompleteReadError):
+        data = b''
+    except BaseException:
+        if writer is not None:
+            writer.close()
+        raise
+    if data.startswith(b'V2'):
+        return reader, writer
+    if writer is not None:
+        writer.close()
+    return None
+
+async def connect_async(supress_output:bool = False, port_cache_ttl:np.floating=5.0, max_port:Optional[int]=None, vid_pid_allowlist:Collection[Tuple[int, int]]=_USB_SERIAL_IDS, **kwargs) -> Optional[Tuple[asyncio.StreamReader, asyncio.StreamWriter]]:
+    """
+    Probe all ports concurrently on the event loop and find the first optical filter
+
+    Parameters
+    ----------
+    supress_output : bool
+        when set to True, status messages are suppressed
+    port_cache_ttl : np.floating
+        time in seconds for which the list of ports is reused between calls, 0 forces a refresh
+    max_port : Optional[int]
+        when set, ports numbered above it (e.g. COM9 for max_port=8) are not probed
+    vid_pid_allowlist : Collection[Tuple[int, int]]
+        USB (vid, pid) pairs of the serial bridges to probe, every port is probed when none match
+    **kwargs
+        other arguments when opening serial connection
+
+    Returns
+    -------
+    Tuple[asyncio.StreamReader, asyncio.StreamWriter]
+        streams to communicate with the filter
+
+    Raises
+    ------
+    ImportError
+        when pyserial-asyncio is not installed
+    """
+    _require_serial_asyncio()
+    ports = _candidate_ports(port_cache_ttl, max_port, vid_pid_allowlist)
+    found = None
+    error = None
+    # exceptions are collected rather than raised so that every opened pair is closed or returned
+    for result in await asyncio.gather(*(_probe_async(port, supress_output, **kwargs) for port in ports), return_exceptions=True):
+        if isinstance(result, BaseException):
+            error = error or result
+            continue
+        if result is None: continue
+        if found is None: found = result
+        else: result[1].close()
+    if found is None:
+        if error is not None: raise error
+        print("No optical filter found.")
+    return found
+
+async def scan_async(reader:asyncio.StreamReader, writer:asyncio.StreamWriter, start:int, end:int, stay:np.floating, span:int, progress:Optional[asyncio.Queue] = None) -> Tuple[int, int, np.floating]:
+    """
+    Scan the filter over a range of wavelengths without blocking the event loop
+
+    Parameters
+    ----------
+    reader : asyncio.StreamReader
+        stream to read responses from the filter
+    writer : asyncio.StreamWriter
+        stream to send commands to the filter
+    start : int
+        wavelength at which the scan begins
+    end : int
+        wavelength at which the scan ends
+    stay : np.floating
+        time in seconds for which the scan stay at each wavelength
+    span : int
+        I don't even know what it does
+    progress : Optional[asyncio.Queue]
+        when given, each wavelength reported by the filter is put on this queue
+
+    Returns
+    -------
+    Tuple[int, int, np.floating]
+        a tuple of the previous settings of (start, end, stay)
+
+    Raises
+    ------
+    AssertionError
+        when a device error is encountered
+    ValueError
+        when the scan parameters are invalid
+    """
+    ser = writer.transport.serial
+    if ser.in_waiting > 0:
+        ser.reset_input_buffer()
+        ser.reset_output_buffer()
+    _stay = _check_scan_args(start, end, stay, span)
+    start_prev, end_prev, stay_prev = await write_and_read_pipelined_async(reader, writer, [
+        (_WL_BYTES[start], b'L', b' ', b',', int),
+        (_WL_BYTES[end], b'H', b' ', b',', int),
+        (_FRAC_BYTES[_stay], b'T', b' ', b',', int),
+    ])
+    stay_prev /= 10
+
+    writer.write(b'S%s,' % _FRAC_BYTES[span])
+    while True:
+        data = await reader.readuntil(b' ')
+        if data.startswith(b'o'): break
+        if not data.startswith(b'S'): raise AssertionError(f"Device returned unexpected response: {data}")
+        if len(data) > 2 and progress is not None:
+            progress.put_nowait(int(data[1:-1]))
+
+    return start_prev, end_prev, stay_prev